@@ -1,6 +1,41 @@
 import codecs
+import functools
+import itertools
+import re
+
+@functools.lru_cache(maxsize=128)
+def _decode_delimiter(delimiter):
+    return codecs.decode(delimiter, 'unicode_escape')
+
+@functools.lru_cache(maxsize=32)
+def _delimiter_pattern(delimiter):
+    # Returns the pattern and whether it consumes blank lines.
+    # Delimiters separated only by whitespace are matched as one, so blank lines between them never reach
+    # Python and only the first and last line can be blank. A longer delimiter starting with whitespace
+    # could be matched at a different position than str.split would, so it is matched on its own.
+    if not delimiter:
+        raise ValueError("empty separator")
+    escaped = re.escape(delimiter)
+    if len(delimiter) == 1 or not delimiter[0].isspace():
+        return re.compile(rf'{escaped}(?:\s*{escaped})*'), True
+    return re.compile(escaped), False
+
+def _split_non_blank(text, delimiter):
+    # Lazily yields the same items as [line for line in text.split(delimiter) if line.strip()]
+    # so only the lines that are kept get copied out of text
+    start = 0
+    for match in _delimiter_pattern(delimiter)[0].finditer(text):
+        line = text[start:match.start()]
+        start = match.end()
+        if line.strip():
+            yield line
+    line = text[start:]
+    if line.strip():
+        yield line
 
 class SpotlessTextSplitByDelimiter:
+    __slots__ = ()
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -41,12 +76,25 @@ class SpotlessTextSplitByDelimiter:
 
     def run(self, text,delimiter,start_index,skip_every,max_count):
          
+        step = skip_every + 1
+        stop = start_index + max_count * step
         if delimiter=="":
-            arr=[text.strip()]
+            arr=[text.strip()][start_index:stop:step]
         else:
-            delimiter=codecs.decode(delimiter, 'unicode_escape')
-            arr= [line for line in text.split(delimiter) if line.strip()]
-
-        arr= arr[start_index:start_index + max_count * (skip_every+1):(skip_every+1)]
+            delimiter=_decode_delimiter(delimiter)
+            # Only the first stop lines can be returned, so splitting can stop there.
+            # If dropping blank lines leaves too few, the unsplit rest of the text
+            # is streamed to keep the exact same output.
+            pattern, folds_blank = _delimiter_pattern(delimiter)
+            lines=pattern.split(text, stop)
+            rest=_split_non_blank(lines.pop(), delimiter) if len(lines) > stop else ()
+            if not folds_blank:
+                lines=[line for line in lines if line.strip()]
+            else:
+                if lines and not lines[-1].strip():
+                    lines.pop()
+                if lines and not lines[0].strip():
+                    del lines[0]
+            arr=list(itertools.islice(itertools.chain(lines, rest), start_index, stop, step))
 
         return (arr,)
@@ -15,6 +15,8 @@
 # AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import functools
+import os
 import sys
 from random import Random
 import re
@@ -22,6 +24,24 @@ import server
 from aiohttp import web
 from typing import Dict, Any, List, Tuple
 
+# Set STABLE_WILDCARDS_VERBOSE=0 to stop printing every processed prompt to the console
+VERBOSE = os.environ.get('STABLE_WILDCARDS_VERBOSE', '1') == '1'
+
+# Console messages
+RESULT = '\033[96m Stable Wildcard: (%s) "%s"\033[0m\n'
+HIDDEN_INPUT_MISSING = '\033[96m Stable Wildcard: Hidden input missing or invalid, output not saved in metadata\033[0m\n'
+WORKFLOW_MISSING = '\033[96m Stable Wildcard: Workflow missing or not a dictionary, output not saved in metadata\033[0m\n'
+METADATA_INVALID = '\033[93m Stable Wildcard: "%s" in %s is not a dictionary, cannot save metadata.\033[0m\n'
+
+
+@functools.lru_cache(maxsize=64)
+def seed_state(seed):
+    """
+    Mersenne Twister state for a seed. Restoring a saved state is cheaper than
+    seeding again when the same seed is processed repeatedly.
+    """
+    return Random(seed).getstate()
+
 
 @server.PromptServer.instance.routes.post("/stable-wildcards/process")
 async def process_stable_wildcards(req):
@@ -35,6 +55,8 @@ class StableWildcard:
     ComfyUI Custom Node
     Implements wildcards using a stable seed to make workflows reproducible after creation
     """
+    # No per instance state, skip the instance __dict__
+    __slots__ = ()
 
     def __init__(self):
         pass
@@ -45,8 +67,18 @@ class StableWildcard:
     FUNCTION = "execute"
 
     # A reusable wildcard pattern matches any string with brackets {}
-    # but will not select over other wildcards.
-    WILDCARD_PATTERN = re.compile('{[^{}]+}')
+    # but will not select over other wildcards. The options are captured
+    # in group 1 without the brackets.
+    # The patterns only match brackets and pipes, ASCII mode doesn't change
+    # what they match but lets re skip unicode handling.
+    WILDCARD_PATTERN = re.compile(r'\{([^{}]+)\}', re.ASCII)
+
+    # Matches a wildcard directly inside another {, which means resolving it
+    # may produce a new wildcard that has to be resolved afterwards.
+    NESTED_PATTERN = re.compile(r'\{[^{}]*\{[^{}]+\}', re.ASCII)
+
+    # Matches a single bracket, used to walk nested wildcards
+    BRACE_PATTERN = re.compile(r'[{}]', re.ASCII)
 
     @classmethod
     def INPUT_TYPES(s):
@@ -83,79 +115,111 @@ class StableWildcard:
         if not isinstance(seed, int):
             raise TypeError(f"seed must be an integer, but got {type(seed).__name__}")
 
+        # A wildcard needs both brackets, without them there is nothing to
+        # replace so skip the RNG and regex entirely
+        if '{' not in prompt or '}' not in prompt:
+            return prompt
+
         # Setup RNG
-        rng = Random(int(seed))
-        
-        # Search & replace matches
-        match = StableWildcard.WILDCARD_PATTERN.search(prompt)
-        while match:
-            # Get the options - Remove the {}, split by | character
-            # Because the search pattern requires at least one character,
-            # ops is guaranteed to have at least one option
-            ops = match.group()[1:-1].split('|')
-
-            if not ops:
-                continue
-            
-            # Pick a random option.
-            pick = ops[rng.randint(0, len(ops) - 1)]
-            
-            # Replace the match and update the string
-            # Limit one match incase there are repeated wildcards
-            prompt = prompt.replace(match.group(), pick, 1)
-
-            # Search for more wildcards
-            match = StableWildcard.WILDCARD_PATTERN.search(prompt)
-        return prompt
+        # Random() would seed itself from the OS only to be overwritten, so skip
+        # __init__. A new instance per call keeps this thread safe.
+        rng = Random.__new__(Random)
+        rng.setstate(seed_state(int(seed)))
+
+        # choice(), randint(0, n - 1) and randrange(n) all return _randbelow(n),
+        # calling it directly skips their call overhead and consumes the exact
+        # same draws, so existing workflows remain reproducible.
+        randbelow = rng._randbelow
+
+        # Options by wildcard body, repeated wildcards are only split once
+        options_cache = {}
+
+        def pick(body):
+            # Split by | character. Because the search pattern requires at
+            # least one character, there is always at least one option.
+            options = options_cache.get(body)
+            if options is None:
+                options = options_cache[body] = tuple(body.split('|'))
+
+            # Pick a random option. A single option still consumes a draw,
+            # otherwise the random sequence, and therefore existing seeds,
+            # would change.
+            return options[randbelow(len(options))]
+
+        def pick_match(match):
+            # Get the options without the {}
+            return pick(match.group(1))
+
+        # Without nesting, no replacement can form a new match, so a single
+        # left to right pass visits wildcards in the same order (and consumes
+        # the same random draws) as resolving the leftmost match repeatedly.
+        if not StableWildcard.NESTED_PATTERN.search(prompt):
+            return StableWildcard.WILDCARD_PATTERN.sub(pick_match, prompt)
+
+        # Nested wildcards resolve from the inside out, in the order their }
+        # appear. Build the output in one pass, keeping the position of each
+        # unresolved { so a wildcard is replaced as soon as it is closed and
+        # its result becomes part of any wildcard around it.
+        parts = []
+        opened = []
+        end = 0
+        for brace in StableWildcard.BRACE_PATTERN.finditer(prompt):
+            parts.append(prompt[end:brace.start()])
+            end = brace.end()
+            if brace.group() == '{':
+                opened.append(len(parts))
+                parts.append('{')
+            elif opened:
+                start = opened.pop()
+                body = ''.join(parts[start + 1:])
+                if body:
+                    del parts[start:]
+                    parts.append(pick(body))
+                else:
+                    # {} is not a wildcard, it stays in the output and
+                    # separates everything before it from what follows
+                    parts.append('}')
+                    opened.clear()
+            else:
+                parts.append('}')
+        parts.append(prompt[end:])
+        return ''.join(parts)
 
     def execute(self, prompt, seed, **kwargs):
         """
         Process the wildcards for execution
         """
-        if prompt is None:
-            raise TypeError("prompt cannot be None")
-        if not isinstance(prompt, str):
-            raise TypeError(f"prompt must be a string, but got {type(prompt).__name__}")
-        if seed is None:
-            raise TypeError("seed cannot be None")
-        if not isinstance(seed, int):
-            raise TypeError(f"seed must be an integer, but got {type(seed).__name__}")
-
-        # Process the wildcards
+        # Process the wildcards, this also validates prompt and seed
         prompt = self.process_wildcards(prompt, seed)
 
         # Output result console
-        print(f'\033[96m Stable Wildcard: ({seed}) "{prompt}"\033[0m')
+        if VERBOSE:
+            sys.stdout.write(RESULT % (seed, prompt))
 
         unique_id = kwargs.get('id')
         png_info = kwargs.get('png_info')
 
         # Save output into metadata if everything exists
-        if unique_id is not None and png_info is not None and isinstance(png_info, dict):
-            # Check for workflow and extra
+        if unique_id is None or not isinstance(png_info, dict):
+            sys.stdout.write(HIDDEN_INPUT_MISSING)
+        else:
+            # Workflow is missing for prompts queued through the API, this is not an error
             workflow = png_info.get('workflow')
-            if workflow is not None and isinstance(workflow, dict):
-                # Create extra if missing
-                if 'extra' not in workflow:
-                    workflow['extra'] = {}
-                
-                if isinstance(workflow.get('extra'), dict):
-                    extra_data = workflow['extra']
-                    # Create a namespace if necessary
-                    if 'stable-wildcards' not in extra_data:
-                        extra_data['stable-wildcards'] = {}
-                    
-                    # Save the result in metadata by id
-                    if isinstance(extra_data.get('stable-wildcards'), dict):
-                        extra_data['stable-wildcards'][unique_id] = prompt
-                    else:
-                        print('\033[93m Stable Wildcard: "stable-wildcards" in extra is not a dictionary, cannot save metadata.\033[0m')
-                else:
-                    print('\033[93m Stable Wildcard: "extra" in workflow is not a dictionary, cannot save metadata.\033[0m')
+            if not isinstance(workflow, dict):
+                sys.stdout.write(WORKFLOW_MISSING)
             else:
-                print('\033[96m Stable Wildcard: Workflow missing or not a dictionary, output not saved in metadata\033[0m')
-        else:
-            print('\033[96m Stable Wildcard: Hidden input missing or invalid, output not saved in metadata\033[0m')
+                try:
+                    # Create extra and a namespace if necessary
+                    namespace = workflow.setdefault('extra', {}).setdefault('stable-wildcards', {})
+                except AttributeError:
+                    sys.stdout.write(METADATA_INVALID % ('extra', 'workflow'))
+                else:
+                    # Save the result in metadata by id. Any other type could be
+                    # overwritten by index, so only a dictionary is accepted.
+                    if isinstance(namespace, dict):
+                        namespace[unique_id] = prompt
+                    else:
+                        sys.stdout.write(METADATA_INVALID % ('stable-wildcards', 'extra'))
 
         return (prompt,)
 